@@ -0,0 +1,183 @@
+from google.api_core.exceptions import NotFound, PreconditionFailed
+from datetime import datetime, timezone
+import logging
+import time
+
+# Cloud Functions time out after 540 seconds at most, a lease older than that belongs to a dead invocation
+LEASE_SECONDS = 540
+DEFAULT_WINDOW_SECONDS = 10
+# the ledger is saved after every batch, keep batches small enough to finish well within the timeout
+DEFAULT_MAX_BATCH = 20
+
+
+class ProcessedLedger(object):
+    """
+    The blob generations a function has already handled, kept as a JSON blob in the bucket.
+    A blob is pending until its current generation is recorded as processed or as failed, so an
+    overwritten blob is handled again while a redelivered event for the same generation is not.
+    """
+
+    def __init__(self, bucket, ledger_path):
+        self._bucket = bucket
+        self._ledger_path = ledger_path
+        b = bucket.get_blob(ledger_path)
+        self._generation = b.generation if b else 0
+        state = bucket.read_json_blob(ledger_path) if b else {}
+        self._processed = state.get('processed', {})
+        self._failed = state.get('failed', {})
+
+    @property
+    def exists(self) -> bool:
+        return self._generation != 0
+
+    def is_processed(self, name, generation) -> bool:
+        return self._processed.get(name) == int(generation)
+
+    def is_failed(self, name, generation) -> bool:
+        return self._failed.get(name, {}).get('generation') == int(generation)
+
+    def is_handled(self, name, generation) -> bool:
+        return self.is_processed(name, generation) or self.is_failed(name, generation)
+
+    def pending(self, blobs, accept=None) -> list:
+        return [b for b in blobs
+                if (accept is None or accept(b.name)) and not self.is_handled(b.name, b.generation)]
+
+    def mark(self, blobs):
+        for b in blobs:
+            self._processed[b.name] = int(b.generation)
+            self._failed.pop(b.name, None)
+
+    def mark_failed(self, blobs, errors):
+        """
+        Record blobs that could not be processed, so they stop blocking the ones behind them.
+        They are retried when a new generation is uploaded.
+        :param errors: the error for each blob, by blob name
+        """
+        for b in blobs:
+            self._failed[b.name] = {'generation': int(b.generation), 'error': str(errors[b.name])}
+
+    def save(self):
+        """
+        Write the ledger back, failing with PreconditionFailed if it changed since it was loaded
+        """
+        self._bucket.upload_json(self._ledger_path, {'processed': self._processed, 'failed': self._failed},
+                                 if_generation_match=self._generation)
+        self._generation = self._bucket.get_blob(self._ledger_path).generation
+
+
+def event_time(data) -> datetime:
+    """
+    The timeCreated of a storage event, as an aware datetime
+    """
+    return datetime.fromisoformat(data["timeCreated"].replace('Z', '+00:00'))
+
+
+def seed_ledger(bucket, ledger_path, folder, accept=None, seed_before=None):
+    """
+    Create the ledger on first use, recording the blobs already in the folder as processed,
+    so that deploying the batching does not reprocess the whole history.
+    :param seed_before: only blobs created before this time are recorded, the blob whose event is being
+    handled and any landing alongside it stay pending, all blobs are recorded if None
+    """
+    ledger = ProcessedLedger(bucket, ledger_path)
+    if ledger.exists:
+        return
+
+    existing = [b for b in ledger.pending(bucket.list(folder), accept)
+                if seed_before is None or b.time_created < seed_before]
+    logging.info(f"Seeding {ledger_path} with {len(existing)} existing blobs from {folder}")
+    ledger.mark(existing)
+    ledger.save()
+
+
+def lease_path_for(ledger_path) -> str:
+    # the lease serialising the work recorded in a ledger lives next to it
+    return f"{ledger_path}.lease"
+
+
+def acquire_lease(bucket, lease_path, lease_seconds=LEASE_SECONDS) -> bool:
+    """
+    Take the lease by creating the lease blob, only one invocation can create it.
+    A lease left behind by a crashed invocation is broken once it is older than lease_seconds.
+    :return: True if this invocation now holds the lease
+    """
+    for _ in range(2):
+        try:
+            bucket.upload_json(lease_path, {'acquired': datetime.now(timezone.utc).isoformat()},
+                               if_generation_match=0)
+            return True
+        except PreconditionFailed:
+            b = bucket.get_blob(lease_path)
+            if b and (datetime.now(timezone.utc) - b.time_created).total_seconds() < lease_seconds:
+                return False
+
+            logging.warning(f"Breaking stale lease {lease_path}")
+            try:
+                if b:
+                    bucket.delete_blob(lease_path, if_generation_match=b.generation)
+            except (NotFound, PreconditionFailed):
+                pass
+
+    return False
+
+
+def release_lease(bucket, lease_path):
+    try:
+        bucket.delete_blob(lease_path)
+    except NotFound:
+        pass
+
+
+def drain(bucket, ledger_path, folder, process_batch, accept=None, order=None, seed_before=None,
+          window_seconds=DEFAULT_WINDOW_SECONDS, max_batch=DEFAULT_MAX_BATCH) -> int:
+    """
+    Coalesce storage events: process every pending blob in the folder as batches, holding a lease so
+    that the events of a burst do not each redo the work. Events arriving while another invocation
+    holds the lease return straight away, the holder picks up their blobs, and pending blobs are
+    checked again after the lease is released so none are stranded.
+    :param bucket: the bucket holding the blobs, the ledger and the lease
+    :param ledger_path: path of the ProcessedLedger blob, the lease lives next to it
+    :param folder: prefix of the blobs to process
+    :param process_batch: called with the bucket and a list of pending blobs, returns the errors of the blobs
+    it could not process by blob name, these are logged and recorded as failed instead of retried
+    :param accept: optional filter on the blob name
+    :param seed_before: blobs created from this time on are left pending when the ledger is seeded on first use,
+    see seed_ledger
+    :param order: optional sort key on the blobs, pending blobs are processed in this order, by name otherwise
+    :param window_seconds: wait this long after taking the lease so blobs landing together share a batch
+    :param max_batch: maximum number of blobs passed to process_batch at once, the ledger is saved after each batch
+    :return: the number of blobs processed successfully by this invocation
+    """
+    lease_path = lease_path_for(ledger_path)
+    total = 0
+
+    while acquire_lease(bucket, lease_path):
+        try:
+            seed_ledger(bucket, ledger_path, folder, accept, seed_before)
+            time.sleep(window_seconds)
+            while True:
+                ledger = ProcessedLedger(bucket, ledger_path)
+                pending = ledger.pending(bucket.list(folder), accept)
+                blobs = sorted(pending, key=order or (lambda b: b.name))[:max_batch]
+                if not blobs:
+                    break
+
+                logging.info(f"Processing a batch of {len(blobs)} blobs from {folder}")
+                errors = process_batch(bucket, blobs) or {}
+                for name, error in errors.items():
+                    logging.error(f"Failed to process {name}: {error}")
+
+                ledger.mark([b for b in blobs if b.name not in errors])
+                ledger.mark_failed([b for b in blobs if b.name in errors], errors)
+                ledger.save()
+                total += len(blobs) - len(errors)
+        finally:
+            release_lease(bucket, lease_path)
+
+        # a blob may have landed after the last listing while its event found the lease still held
+        if not ProcessedLedger(bucket, ledger_path).pending(bucket.list(folder), accept):
+            break
+        window_seconds = 0
+
+    return total
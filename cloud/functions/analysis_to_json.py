@@ -1,14 +1,21 @@
 import functions_framework
-from google.cloud import storage
 import pandas as pd
-from io import StringIO
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, date
+from cloud.util import Bucket
+from cloud.batching import ProcessedLedger, drain, event_time, acquire_lease, release_lease, lease_path_for
 
 PROJECT_NAME = "data-attic"
 BUCKET_NAME = "ev-chargers-opencharge"
 
 analysis_blob_name = "analysis/opencharge.csv"
+snapshots_folder = "data"
+ledger_blob_name = "state/analysis_to_json.json"
+
+SUMMARY_COLUMNS = ['numConnectors', 'numFastConnectors', 'numOperationalConnectors',
+                   'numOperationalFastConnectors', 'numAC', 'numDC']
+SNAPSHOT_DTYPES = {'operatorName': 'string', 'locationName': 'string', **{c: 'int32' for c in SUMMARY_COLUMNS}}
 
 
 def print_event(evt_data):
@@ -26,13 +33,11 @@ def print_event(evt_data):
 
 
 def get_bucket(bucket_name):
-    storage_client = storage.Client(project='data-attic')
-    return storage_client.get_bucket(bucket_name)
+    return Bucket(PROJECT_NAME, bucket_name)
 
 
 def load_from_bucket(bucket, blob_name) -> pd.DataFrame:
-    blob = bucket.blob(blob_name)
-    return pd.read_csv(StringIO(blob.download_as_text()))
+    return bucket.read_csv_blob_as_dataframe(blob_name)
 
 
 def analyze_opencharge(t) -> pd.DataFrame:
@@ -50,36 +55,184 @@ def analyze_opencharge(t) -> pd.DataFrame:
     return summary_table
 
 
-def create_summary(bucket, blob_name) -> pd.DataFrame:
-    t = load_from_bucket(bucket, blob_name)
+def is_snapshot_blob(blob_name) -> bool:
+    # only interested in the data folder csv files, ignore all others
+    if not (blob_name.startswith(snapshots_folder) and blob_name.endswith("csv")):
+        return False
+
+    # a snapshot has to be dated by its name to be summarised and ordered
+    try:
+        snapshot_time_from_blob_name(blob_name)
+    except ValueError:
+        return False
+    return True
 
-    summary = analyze_opencharge(t)
 
+def snapshot_time_from_blob_name(blob_name) -> datetime:
+    # snapshots are named like data/opencharge-groupA-20240202-0600.csv
     endidx = blob_name.rfind('-')
-    datestr = blob_name[endidx - 8:endidx]
+    datestr = blob_name[endidx - 8:endidx + 5]
+
+    return datetime.strptime(datestr, '%Y%m%d-%H%M')
+
+
+def import_date_from_blob_name(blob_name) -> date:
+    return snapshot_time_from_blob_name(blob_name).date()
+
+
+def snapshot_order(blob_name):
+    # oldest first, the name breaks ties between snapshots taken in the same minute
+    return snapshot_time_from_blob_name(blob_name), blob_name
+
+
+def load_snapshot(bucket, blob_name, snapshot=0) -> pd.DataFrame:
+    t = bucket.read_csv_blob_as_dataframe(blob_name, usecols=list(SNAPSHOT_DTYPES), dtype=SNAPSHOT_DTYPES)
+    # only whether a location has a name is counted, a flag is much smaller than the names themselves
+    t['locationName'] = t['locationName'].notna()
+    t['import_date'] = import_date_from_blob_name(blob_name)
+    t['snapshot'] = snapshot
+    return t
+
+
+def load_snapshots(bucket, blob_names, max_workers=8, errors=None) -> pd.DataFrame:
+    """
+    Download many snapshots concurrently into one typed table, tagged with their import date
+    and with snapshot, a number that grows with the time the snapshot was taken
+    :param bucket: the bucket holding the snapshots
+    :param blob_names: paths of the snapshot CSV blobs
+    :param max_workers: number of concurrent downloads
+    :param errors: if given, snapshots that fail to load are left out and their errors collected here
+    by blob name, otherwise the first failure is raised
+    :return: a pandas dataframe with the summary columns plus import_date and snapshot
+    """
+    ordered = sorted(blob_names, key=snapshot_order)
 
-    import_date = datetime.strptime(datestr, '%Y%m%d').date()
+    def load(n):
+        try:
+            return load_snapshot(bucket, ordered[n], n)
+        except Exception as e:
+            if errors is None:
+                raise
+            errors[ordered[n]] = e
+            return None
 
-    print(f"Import date is {import_date}")
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        tables = [t for t in pool.map(load, range(len(ordered))) if t is not None]
 
-    summary['import_date'] = import_date
-    summary.set_index(['import_date'], append=True, inplace=True)
+    if not tables:
+        logging.info("No snapshots to load")
+        tables = [pd.DataFrame({c: pd.Series(dtype=d) for c, d in
+                                {**SNAPSHOT_DTYPES, 'locationName': 'bool', 'import_date': 'object',
+                                 'snapshot': 'int64'}.items()})]
+
+    t = pd.concat(tables, ignore_index=True)
+    t['operatorName'] = t['operatorName'].astype('category')
+    t['import_date'] = t['import_date'].astype('category')
+
+    return t
+
+
+def summarize_snapshots(t) -> pd.DataFrame:
+    """
+    Summarise every operator on every import date in a single grouped aggregation.
+    Produces the same layout as analyze_opencharge with import_date appended to the index.
+    """
+    # several snapshots of a day can cover the same operator, e.g. a retried download, only the latest counts
+    latest = t.groupby(['operatorName', 'import_date'], observed=True)['snapshot'].transform('max')
+    t = t[t['snapshot'] == latest]
+
+    aggs = {'locationName': ('locationName', 'sum'), **{c: (c, 'sum') for c in SUMMARY_COLUMNS}}
+    summary = t.groupby(['operatorName', 'import_date'], observed=True).agg(**aggs)
+
+    summary.index = summary.index.set_levels([summary.index.levels[0].astype(str),
+                                              summary.index.levels[1].astype(object)])
+    return summary.sort_index()
+
+
+def create_summary(bucket, blob_name) -> pd.DataFrame:
+    summary = summarize_snapshots(load_snapshots(bucket, [blob_name]))
+
+    print(f"Import date is {import_date_from_blob_name(blob_name)}")
 
     return summary
 
 
+def rebuild_analysis(bucket, folder=snapshots_folder) -> pd.DataFrame:
+    """
+    Recompute the analysis table from every snapshot in the folder and write it in one pass,
+    replacing whatever was there, e.g. after a schema change or a lost update.
+    Takes the lease the storage trigger drains under, so the two never write the table at once.
+    :return: the rebuilt analysis table, or None if the lease is held elsewhere
+    """
+    lease_path = lease_path_for(ledger_blob_name)
+    if not acquire_lease(bucket, lease_path):
+        logging.warning(f"Not rebuilding, {lease_path} is held by a running update")
+        return None
+
+    try:
+        ledger = ProcessedLedger(bucket, ledger_blob_name)
+        blobs = [b for b in bucket.list(folder) if is_snapshot_blob(b.name)]
+        logging.info(f"Rebuilding {analysis_blob_name} from {len(blobs)} snapshots")
+
+        errors = {}
+        analysis_table = summarize_snapshots(load_snapshots(bucket, [b.name for b in blobs], errors=errors))
+        save_to_cloud(bucket, analysis_blob_name, analysis_table)
+
+        # the snapshots are all accounted for, storage events for them need not merge them again
+        for name, error in errors.items():
+            logging.error(f"Left {name} out of the rebuild: {error}")
+        ledger.mark([b for b in blobs if b.name not in errors])
+        ledger.mark_failed([b for b in blobs if b.name in errors], errors)
+        ledger.save()
+    finally:
+        release_lease(bucket, lease_path)
+
+    logging.info(f"Saved analysis table with {len(analysis_table)} rows")
+    return analysis_table
+
+
 def load_analysis_from_cloud(bucket, blobname) -> pd.DataFrame:
     table = load_from_bucket(bucket, blobname)
 
-    # table['import_date'] = pd.to_datetime(table['import_date'], format='%Y-%m-%d')
+    table['import_date'] = pd.to_datetime(table['import_date'], format='%Y-%m-%d').dt.date
     table.set_index(['operatorName', 'import_date'], inplace=True)
 
     return table
 
 
 def save_to_cloud(bucket, blobname, table_to_append):
-    blob = bucket.get_blob(blobname)
-    blob.upload_from_string(table_to_append.to_csv())
+    bucket.upload_blob(blobname, table_to_append, content_type="text/csv")
+
+
+def merge_summaries(analysis_table, summary_table) -> pd.DataFrame:
+    # replace rows already in the analysis for the same operator and date, so re-processing a snapshot is harmless
+    kept = analysis_table[~analysis_table.index.isin(summary_table.index)]
+    return pd.concat([kept, summary_table]).sort_index()
+
+
+def process_batch(bucket, blobs) -> dict:
+    """
+    Summarise a batch of snapshots and merge them into the analysis table with a single read and write
+    :return: the errors of the snapshots that could not be loaded, by blob name
+    """
+    errors = {}
+    snapshots = load_snapshots(bucket, [b.name for b in blobs], errors=errors)
+    if len(errors) == len(blobs):
+        return errors
+
+    summary_table = summarize_snapshots(snapshots)
+
+    analysis_table = load_analysis_from_cloud(bucket, analysis_blob_name)
+
+    new_table = merge_summaries(analysis_table, summary_table)
+
+    logging.info(f"New analysis table length is {len(new_table)}")
+
+    save_to_cloud(bucket, analysis_blob_name, new_table)
+
+    logging.info(f"Saved to cloud")
+
+    return errors
 
 
 # Triggered by a change in a storage bucket
@@ -92,23 +245,29 @@ def hello_gcs(cloud_event):
     bucketname = data["bucket"]
     blobname = data["name"]
 
-    # only interested in the data folder csv files, ignore all others
-    if not (blobname.startswith('data') and blobname.endswith("csv")):
+    if not is_snapshot_blob(blobname):
         return
 
     bucket = get_bucket(bucketname)
 
-    summary_table = create_summary(bucket, blobname)
-
-    analysis_table = load_analysis_from_cloud(bucket, analysis_blob_name)
-
-    new_table = pd.concat([analysis_table, summary_table])
-
-    logging.info(f"New analysis table length is {len(new_table)}")
+    if ProcessedLedger(bucket, ledger_blob_name).is_handled(blobname, data["generation"]):
+        print(f"Generation {data['generation']} of {blobname} already processed")
+        return
 
-    save_to_cloud(bucket, analysis_blob_name, new_table)
+    # snapshots landing together are merged by whichever invocation holds the lease
+    processed = drain(bucket, ledger_blob_name, snapshots_folder, process_batch, accept=is_snapshot_blob,
+                      order=lambda b: snapshot_order(b.name), seed_before=event_time(data))
+    print(f"{processed} snapshots merged into {analysis_blob_name}")
 
-    logging.info(f"Saved to cloud")
 
+# Triggered from a message on a Cloud Pub/Sub topic, rebuilds the whole analysis table
+@functions_framework.cloud_event
+def hello_pubsub(cloud_event):
+    rebuild_analysis(get_bucket(BUCKET_NAME))
 
 
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    rebuilt = rebuild_analysis(get_bucket(BUCKET_NAME))
+    if rebuilt is not None:
+        print(f"Got {len(rebuilt)} rows")
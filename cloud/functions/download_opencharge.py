@@ -1,9 +1,8 @@
 import base64
 import functions_framework
-import json
 import requests as req
-from google.cloud import storage
 import datetime as dt
+from cloud.util import Bucket
 
 bucket_name = "ev-chargers-opencharge"
 
@@ -43,13 +42,8 @@ headers = {
 
 
 def save_to_bucket(name, jchargers):
-    storage_client = storage.Client(project='data-attic')
-
-    bucket = storage_client.get_bucket(bucket_name)
-    blob = bucket.blob(name)
-
-    with blob.open('w') as b:
-        b.write(json.dumps(jchargers, indent=2))
+    bucket = Bucket('data-attic', bucket_name)
+    bucket.upload_json(name, jchargers)
 
 
 def get_provider_codes(evt_msg):
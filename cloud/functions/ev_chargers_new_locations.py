@@ -1,50 +1,17 @@
 import base64
 import functions_framework
 import pandas as pd
-from google.cloud import storage
-from io import StringIO
 import logging
 from datetime import datetime, date
+from cloud.util import Bucket
+from cloud.grid import build_density_grid
 
 PROJECT_NAME = "data-attic"
 BUCKET_NAME = "ev-chargers-opencharge"
 
 analysis_blob_name = "analysis/opencharge.csv"
 loc_analysis_blob_name = 'analysis/by_loc.csv'
-
-
-class Bucket(object):
-
-    def __init__(self, project, bucket_name):
-        self._bucket_name = bucket_name
-        self._client = storage.Client(project=project)
-        self._bucket = self._client.get_bucket(bucket_name)
-
-    def list(self, folder=None):
-        return self._client.list_blobs(self._bucket_name, prefix=folder)
-
-    def get_blob(self, path):
-        return self._bucket.get_blob(path)
-
-    def download_blob_as_text(self, blob_path) -> str:
-        b = self.get_blob(blob_path)
-        return b.download_as_text(encoding='utf-8')
-
-    def read_csv_blob_as_dataframe(self, blob_path) -> pd.DataFrame:
-        """
-        Download the blob as a pandas dataframe.
-        We make the assumption the blob is a CSV file
-        :param blob_path: the path in the cloud to the CSV blob
-        :return: a pandas dataframe or None
-        """
-        b = self.get_blob(blob_path)
-        return pd.read_csv(StringIO(b.download_as_text(encoding='utf-8'))) if b else None
-
-    def get_bucket(self):
-        return self._bucket
-
-    def upload_blob(self, blobname: str, t: pd.DataFrame, content_type="text/plain"):
-        self._bucket.blob(blobname).upload_from_string(t.to_csv(), content_type=content_type)
+grid_analysis_blob_name = 'analysis/grid.csv'
 
 
 def new_locations_by_date(bucket_=None, limit=None) -> pd.DataFrame:
@@ -72,7 +39,7 @@ def new_locations_by_date(bucket_=None, limit=None) -> pd.DataFrame:
         if blob_date <= from_date:
             continue
 
-        t = pd.read_csv(StringIO(b.download_as_text()), index_col=0)
+        t = bucket.read_csv_blob_as_dataframe(b.name, has_index=True)
         t.sort_values(['operatorName'], inplace=True)
         t = t[t.columns.difference(['lastUpdated', 'dateCreated'])]
         t['import_datestamp'] = blob_date
@@ -117,5 +84,9 @@ def hello_pubsub(cloud_event):
         buck.upload_blob(loc_analysis_blob_name, new_locs, content_type="text/csv")
         logging.info(f"new_locs file uploaded to cloud {loc_analysis_blob_name}")
 
+        grid = build_density_grid(new_locs)
+        buck.upload_blob(grid_analysis_blob_name, grid, content_type="text/csv")
+        logging.info(f"Density grid of {len(grid)} cells uploaded to cloud {grid_analysis_blob_name}")
+
 
 
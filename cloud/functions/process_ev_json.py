@@ -1,18 +1,21 @@
 import functions_framework
 
-from google.cloud import storage
 import pandas as pd
-import json
+from cloud.util import Bucket
+from cloud.batching import ProcessedLedger, drain, event_time
+
+PROJECT_NAME = "data-attic"
+
+downloads_folder = "downloads"
+ledger_blob_name = "state/process_ev_json.json"
 
 
 def get_bucket(bucket_name):
-    storage_client = storage.Client(project='data-attic')
-    return storage_client.get_bucket(bucket_name)
+    return Bucket(PROJECT_NAME, bucket_name)
 
 
 def load_from_bucket(bucket, blob_name):
-    blob = bucket.blob(blob_name)
-    return json.loads(blob.download_as_text())
+    return bucket.read_json_blob(blob_name)
 
 
 def process_each_charger(charger):
@@ -78,14 +81,38 @@ def process_each_charger(charger):
             'numAC': numAC, 'numDC': numDC}
 
 
-def convert_to_csv(jchargers):
+def convert_to_table(jchargers) -> pd.DataFrame:
     dict_charger_list = [process_each_charger(c) for c in jchargers]
-    t = pd.DataFrame(dict_charger_list)
-    return t.to_csv()
+    return pd.DataFrame(dict_charger_list)
+
+
+def write_to_blob(bucket, blob_name, table):
+    bucket.upload_blob(blob_name, table, content_type="text/csv")
+
+
+def is_download_blob(blob_name) -> bool:
+    return blob_name.startswith(downloads_folder) and blob_name.endswith('json')
 
 
-def write_to_blob(blob, csv_table):
-    blob.upload_from_string(csv_table)
+def convert_download(bucket, blob_name):
+    jchargers = load_from_bucket(bucket, blob_name)
+    print(f"{len(jchargers)} records downloaded from {blob_name}")
+
+    table = convert_to_table(jchargers)
+
+    csv_name = blob_name[blob_name.find('/') + 1:blob_name.rfind('.')]
+    write_to_blob(bucket, f"data/{csv_name}.csv", table)
+
+
+def process_batch(bucket, blobs) -> dict:
+    # a download that cannot be converted, e.g. an API error saved as the response, must not block the others
+    errors = {}
+    for b in blobs:
+        try:
+            convert_download(bucket, b.name)
+        except Exception as e:
+            errors[b.name] = e
+    return errors
 
 
 def print_info(data):
@@ -115,17 +142,19 @@ def hello_gcs(cloud_event):
     bucketname = data["bucket"]
     blobname = data["name"]
 
-    if not blobname.endswith('json'):
+    if not is_download_blob(blobname):
         return
 
     bucket = get_bucket(bucketname)
 
-    jchargers = load_from_bucket(bucket, blobname)
-    print(f"{len(jchargers)} records downloaded")
-
-    csv_table = convert_to_csv(jchargers)
+    if ProcessedLedger(bucket, ledger_blob_name).is_handled(blobname, data["generation"]):
+        print(f"Generation {data['generation']} of {blobname} already processed")
+        return
 
-    csv_name = blobname[blobname.find('/') + 1:blobname.rfind('.')]
-    write_to_blob(bucket.blob(f"data/{csv_name}.csv"), csv_table)
+    # blobs landing together are converted by whichever invocation holds the lease
+    # each conversion is recorded as soon as it is done, a timeout never loses more than one
+    processed = drain(bucket, ledger_blob_name, downloads_folder, process_batch, accept=is_download_blob,
+                      seed_before=event_time(data), max_batch=1)
+    print(f"{processed} downloads processed")
 
 
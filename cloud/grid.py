@@ -0,0 +1,82 @@
+import math
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+# roughly 11km x 7km cells over the UK
+GRID_CELL_DEGREES = 0.1
+WEEKLY_INTERVAL_ON_WEEKDAY = 4  # 4 is Friday
+
+GRID_KEYS = ['operatorName', 'week', 'cell_lat', 'cell_lng']
+# every metric the dashboard can chart, so the heatmap can show each of them
+GRID_SUM_COLUMNS = ['numConnectors', 'numFastConnectors', 'numDC', 'numAC',
+                    'numOperationalConnectors', 'numOperationalFastConnectors']
+GRID_METRICS = ['loc_count'] + GRID_SUM_COLUMNS
+
+
+def calc_next_friday(from_date: datetime) -> datetime:
+    # except when it is Saturday or Sunday, then return the Friday before
+    return from_date + timedelta(days=WEEKLY_INTERVAL_ON_WEEKDAY - from_date.weekday())
+
+
+def week_starting(d):
+    # the Friday on or before the date, so the weeks split at the Fridays of the dashboard date slider
+    return d - timedelta(days=(d.weekday() - WEEKLY_INTERVAL_ON_WEEKDAY) % 7)
+
+
+def build_density_grid(t, cell_degrees=GRID_CELL_DEGREES) -> pd.DataFrame:
+    """
+    Pre-aggregate the locations table into fixed-size lat/lng cells per operator per week starting on
+    a Friday, so coverage can be drawn by summing cells instead of touching every location.
+    :param t: the by_loc table, with operatorName, lat, lng, import_datestamp and the connector counts
+    :param cell_degrees: size of a cell side in degrees
+    :return: a pandas dataframe keyed by GRID_KEYS with the GRID_METRICS, cells are integer
+    indices, the south west corner of a cell is (cell_lat * cell_degrees, cell_lng * cell_degrees)
+    """
+    g = pd.DataFrame({'operatorName': t['operatorName'],
+                      'week': pd.to_datetime(t['import_datestamp']).dt.date.map(week_starting),
+                      'cell_lat': (t['lat'] // cell_degrees).astype(int),
+                      'cell_lng': (t['lng'] // cell_degrees).astype(int),
+                      **{c: t[c].astype(int) for c in GRID_SUM_COLUMNS}})
+
+    grid = g.groupby(GRID_KEYS).agg(loc_count=('numConnectors', 'count'),
+                                    **{c: (c, 'sum') for c in GRID_SUM_COLUMNS})
+    return grid.reset_index()
+
+
+def cell_polygon(cell_lat, cell_lng, cell_degrees=GRID_CELL_DEGREES):
+    """
+    The GeoJSON polygon coordinates of a cell, as [lng, lat] pairs
+    """
+    s, w = round(cell_lat * cell_degrees, 6), round(cell_lng * cell_degrees, 6)
+    n, e = round(s + cell_degrees, 6), round(w + cell_degrees, 6)
+    return [[[w, s], [e, s], [e, n], [w, n], [w, s]]]
+
+
+def sum_cells(grid, operators, from_week, to_week, metric) -> pd.DataFrame:
+    """
+    Total a metric per cell over the selected operators and weeks, from_week inclusive, to_week exclusive.
+    With Friday boundaries this covers exactly the import dates from from_week up to the day before to_week.
+    :return: a pandas dataframe with cell_lat, cell_lng and the metric, empty cells left out
+    """
+    g = grid[grid['operatorName'].isin(operators) & (grid['week'] >= from_week) & (grid['week'] < to_week)]
+    cells = g.groupby(['cell_lat', 'cell_lng'], as_index=False)[metric].sum()
+    return cells[cells[metric] > 0]
+
+
+def cells_to_geojson(cells, metric, colorscale, cell_degrees=GRID_CELL_DEGREES):
+    """
+    Turn summed cells into GeoJSON polygons coloured by a log scale of the metric
+    :param colorscale: a function mapping values in [0, 1] to colours
+    """
+    if len(cells) == 0:
+        return {'type': 'FeatureCollection', 'features': []}
+
+    top = math.log1p(cells[metric].max()) or 1
+    colours = colorscale([math.log1p(v) / top for v in cells[metric]])
+
+    features = [{'type': 'Feature',
+                 'geometry': {'type': 'Polygon', 'coordinates': cell_polygon(lat, lng, cell_degrees)},
+                 'properties': {'value': int(v), 'color': c, 'tooltip': f"{metric}: {int(v)}"}}
+                for lat, lng, v, c in zip(cells['cell_lat'], cells['cell_lng'], cells[metric], colours)]
+    return {'type': 'FeatureCollection', 'features': features}
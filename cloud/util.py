@@ -1,41 +1,241 @@
 from google.cloud import storage
-from io import StringIO
+from google.api_core.exceptions import NotFound, PreconditionFailed
+from contextlib import contextmanager
+from datetime import datetime, timezone
 import pandas as pd
+import gzip
+import io
+import json
 import os
+import tempfile
 import time
 import logging
 
+GZIP_MAGIC = b'\x1f\x8b'
 
-class Bucket(object):
+# GCS requires chunk sizes for resumable uploads to be a multiple of 256 KB
+IO_CHUNK_SIZE = 4 * 256 * 1024
+CSV_CHUNK_ROWS = 10000
 
-    def __init__(self, project, bucket_name):
-        self._bucket_name = bucket_name
-        self._client = storage.Client(project=project)
-        self._bucket = self._client.get_bucket(bucket_name)
+
+class BaseBucket(object):
+    """
+    Blob I/O shared by the cloud and the local-disk buckets.
+    Everything is written gzip-compressed and streamed to the blob in chunks, reads
+    inflate on the fly, so blobs written before compression was introduced still load.
+    Subclasses only provide listing, lookup and the raw binary streams.
+    """
 
     def list(self, folder=None):
-        return self._client.list_blobs(self._bucket_name, prefix=folder)
+        raise NotImplementedError
 
     def get_blob(self, path):
-        return self._bucket.get_blob(path)
+        raise NotImplementedError
 
-    def download_blob_as_text(self, blob_path) -> str:
+    def _open_raw_reader(self, blob):
+        raise NotImplementedError
+
+    def _open_raw_writer(self, path, content_type, if_generation_match=None):
+        raise NotImplementedError
+
+    def delete_blob(self, path, if_generation_match=None):
+        raise NotImplementedError
+
+    def _commit_raw_writer(self, raw):
+        raw.close()
+
+    def _abort_raw_writer(self, raw):
+        pass
+
+    @contextmanager
+    def open_reader(self, blob_path):
+        """
+        Open the blob for streamed binary reading, inflating gzip payloads transparently
+        :param blob_path: the path in the cloud to the blob
+        :return: a context manager giving a binary file object, or None if the blob does not exist
+        """
         b = self.get_blob(blob_path)
-        return b.download_as_text(encoding='utf-8') if b else None
+        if not b:
+            yield None
+            return
 
-    def read_csv_blob_as_dataframe(self, blob_path, has_index=False) -> pd.DataFrame:
+        with self._open_raw_reader(b) as raw:
+            stream = raw if hasattr(raw, 'peek') else io.BufferedReader(raw, IO_CHUNK_SIZE)
+            if stream.peek(len(GZIP_MAGIC))[:len(GZIP_MAGIC)] == GZIP_MAGIC:
+                with gzip.GzipFile(fileobj=stream, mode='rb') as gz:
+                    yield gz
+            else:
+                yield stream
+
+    def write_stream(self, blob_path, write_fn, content_type="text/plain", if_generation_match=None):
+        """
+        Stream text into a gzip-compressed blob.
+        The blob is only committed if write_fn returns without raising.
+        :param blob_path: the path in the cloud to the blob
+        :param write_fn: called with a text file object to write the payload into
+        :param content_type: content type of the uncompressed payload
+        :param if_generation_match: only commit if the blob is at this generation, 0 if it must not exist,
+        raises PreconditionFailed otherwise
+        """
+        raw = self._open_raw_writer(blob_path, content_type, if_generation_match)
+        try:
+            # closing the gzip stream writes its trailer but leaves raw open, it is committed separately
+            with io.TextIOWrapper(gzip.GzipFile(fileobj=raw, mode='wb'), encoding='utf-8') as f:
+                write_fn(f)
+        except BaseException:
+            self._abort_raw_writer(raw)
+            raise
+
+        self._commit_raw_writer(raw)
+
+    def download_blob_as_text(self, blob_path) -> str:
+        with self.open_reader(blob_path) as f:
+            return f.read().decode('utf-8') if f is not None else None
+
+    def read_csv_blob_as_dataframe(self, blob_path, has_index=False, **kwargs) -> pd.DataFrame:
         """
         Download the blob as a pandas dataframe.
         We make the assumption the blob is a CSV file
         :param blob_path: the path in the cloud to the CSV blob
-        :return: a pandas dataframe or None
+        :param has_index: use the first column as the index
+        :param kwargs: passed on to pandas read_csv, e.g. usecols or dtype
+        :return: a pandas dataframe, or None if the blob does not exist or is empty
         """
-        txt = self.download_blob_as_text(blob_path)
-        return pd.read_csv(StringIO(txt), index_col=0 if has_index else None) if txt else None
+        with self.open_reader(blob_path) as f:
+            if f is None:
+                return None
+            try:
+                return pd.read_csv(f, index_col=0 if has_index else None, **kwargs)
+            except pd.errors.EmptyDataError:
+                return None
+
+    def read_json_blob(self, blob_path):
+        with self.open_reader(blob_path) as f:
+            return json.load(f) if f is not None else None
+
+    def upload_blob(self, blobname: str, t: pd.DataFrame, content_type="text/csv"):
+        self.write_stream(blobname, lambda f: t.to_csv(f, chunksize=CSV_CHUNK_ROWS), content_type=content_type)
+
+    def upload_json(self, blobname: str, obj, content_type="application/json", if_generation_match=None):
+        self.write_stream(blobname, lambda f: json.dump(obj, f), content_type=content_type,
+                          if_generation_match=if_generation_match)
+
+
+class Bucket(BaseBucket):
+
+    def __init__(self, project, bucket_name):
+        self._bucket_name = bucket_name
+        self._client = storage.Client(project=project)
+        self._bucket = self._client.get_bucket(bucket_name)
+
+    def list(self, folder=None):
+        return self._client.list_blobs(self._bucket_name, prefix=folder)
+
+    def get_blob(self, path):
+        return self._bucket.get_blob(path)
 
     def get_bucket(self):
         return self._bucket
 
+    def _open_raw_reader(self, blob):
+        # fetch the stored bytes, GCS would otherwise decompress gzip blobs itself and break ranged reads
+        return blob.open('rb', chunk_size=IO_CHUNK_SIZE, raw_download=True)
+
+    def _open_raw_writer(self, path, content_type, if_generation_match=None):
+        blob = self._bucket.blob(path)
+        blob.content_encoding = 'gzip'
+        kwargs = {'if_generation_match': if_generation_match} if if_generation_match is not None else {}
+        return blob.open('wb', chunk_size=IO_CHUNK_SIZE, ignore_flush=True, content_type=content_type, **kwargs)
+
+    def _abort_raw_writer(self, raw):
+        # never finalize the upload, an unfinished resumable session is discarded by GCS
+        pass
+
+    def delete_blob(self, path, if_generation_match=None):
+        self._bucket.delete_blob(path, if_generation_match=if_generation_match)
+
+
+class LocalBlob(object):
+    """
+    The subset of the GCS blob attributes used by the functions, for blobs on local disk
+    """
+
+    def __init__(self, name, file_path):
+        st = os.stat(file_path)
+        self.name = name
+        self.file_path = file_path
+        self.size = st.st_size
+        self.generation = st.st_mtime_ns
+        self.time_created = datetime.fromtimestamp(st.st_mtime, tz=timezone.utc)
+        self.updated = self.time_created
+
+
+class LocalBucket(BaseBucket):
+    """
+    A bucket backed by a directory on local disk, blob names are paths relative to the root.
+    Used for tests and for running the functions offline.
+    """
+
+    def __init__(self, root):
+        self._root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _file_path(self, path):
+        return os.path.join(self._root, *path.split('/'))
+
+    def list(self, folder=None):
+        blobs = []
+        for dirpath, _, filenames in os.walk(self._root):
+            for fn in filenames:
+                file_path = os.path.join(dirpath, fn)
+                name = os.path.relpath(file_path, self._root).replace(os.sep, '/')
+                if folder is None or name.startswith(folder):
+                    blobs.append(LocalBlob(name, file_path))
+
+        return sorted(blobs, key=lambda b: b.name)
+
+    def get_blob(self, path):
+        file_path = self._file_path(path)
+        return LocalBlob(path, file_path) if os.path.isfile(file_path) else None
+
+    def _open_raw_reader(self, blob):
+        return open(blob.file_path, 'rb')
+
+    def _check_generation(self, path, if_generation_match):
+        if if_generation_match is None:
+            return
+        b = self.get_blob(path)
+        if (b.generation if b else 0) != if_generation_match:
+            raise PreconditionFailed(f"{path} is not at generation {if_generation_match}")
+
+    def _open_raw_writer(self, path, content_type, if_generation_match=None):
+        file_path = self._file_path(path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        # write next to the target and move it into place on commit, so readers never see a partial blob
+        raw = tempfile.NamedTemporaryFile(dir=os.path.dirname(file_path), delete=False)
+        raw.blob_path = path
+        raw.if_generation_match = if_generation_match
+        return raw
+
+    def _commit_raw_writer(self, raw):
+        raw.close()
+        try:
+            self._check_generation(raw.blob_path, raw.if_generation_match)
+        except PreconditionFailed:
+            os.remove(raw.name)
+            raise
+        os.replace(raw.name, self._file_path(raw.blob_path))
+
+    def _abort_raw_writer(self, raw):
+        raw.close()
+        os.remove(raw.name)
+
+    def delete_blob(self, path, if_generation_match=None):
+        if not self.get_blob(path):
+            raise NotFound(f"{path} does not exist")
+        self._check_generation(path, if_generation_match)
+        os.remove(self._file_path(path))
+
 
 def download_table(project, bucket_name, blob_path, has_index=False):
     logging.log(logging.INFO, f"Downloading {blob_path} from {project}:{bucket_name}")
@@ -62,10 +262,9 @@ def load_or_download_blob(project, bucket_name, blob_path, file_path, refresh_af
     # if file doesn't exist or older than cutoff time, reload.
     if force_download or not os.path.exists(file_path) or os.path.getmtime(file_path) < cutoff_seconds:
         t = download_table(project, bucket_name, blob_path)
-        with open(file_path, "w") as f:
-            f.write(t)
+        t.to_csv(file_path, index=False)
 
-        return pd.read_csv(StringIO(t))
+        return t
 
     logging.info(f"Loading file from {file_path}")
     return pd.read_csv(file_path)
@@ -82,5 +281,3 @@ if __name__ == "__main__":
                                       force_download=False)
 
     print(f"Got {len(refreshed)} rows")
-
-
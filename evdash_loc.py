@@ -4,12 +4,14 @@ import dash
 from dash import html, dcc
 from dash.dependencies import Input, Output
 import plotly.express as px
-from datetime import datetime, timedelta
+from datetime import timedelta
 import math
 import logging
+import os
 import dash_leaflet as dl
 import random
 from cloud.util import download_table
+from cloud.grid import build_density_grid, sum_cells, cells_to_geojson, calc_next_friday
 import dash_leaflet.express as dlx
 from dash_extensions.javascript import assign
 
@@ -20,10 +22,9 @@ logging.basicConfig(level=logging.INFO)
 
 PROJECT_NAME = "data-attic"
 BUCKET_NAME = "ev-chargers-opencharge"
-LOC_PATH_LOCAL = "data/by_loc.csv"
+LOC_PATH_LOCAL = os.environ.get("EVDASH_LOC_PATH", "data/by_loc.csv")
 LOC_PATH_CLOUD = "analysis/by_loc.csv"
-
-WEEKLY_INTERVAL_ON_WEEKDAY = 4  # 4 is Friday
+GRID_PATH_CLOUD = "analysis/grid.csv"
 
 
 COLOURS = ['Aquamarine', 'Blue', 'CadetBlue', 'DarkCyan', 'DarkOliveGreen', 'Fuchsia',
@@ -63,12 +64,14 @@ def get_loc_analysis_table(locally=False) -> pd.DataFrame:
 
     return tab
 
-def calc_next_friday(from_date: datetime) -> datetime:
-    # except when it is Saturday or Sunday, then return the Friday before
-    return from_date + timedelta(days=WEEKLY_INTERVAL_ON_WEEKDAY - from_date.weekday())
-
+def get_density_grid(loc_table, locally=False) -> pd.DataFrame:
+    # the local table is small enough to grid on startup, the cloud one is gridded on ingestion
+    grid = build_density_grid(loc_table) if locally else download_table(PROJECT_NAME, BUCKET_NAME, GRID_PATH_CLOUD, has_index=True)
+    grid['week'] = pd.to_datetime(grid['week']).dt.date
+    return grid
 
 t = get_loc_analysis_table(locally=True)
+grid = get_density_grid(t, locally=True)
 
 # get daterange from start to finish in table and calculate intervals of every Friday
 all_dates = sorted(t['import_datestamp'].unique())
@@ -113,6 +116,7 @@ slider_marks = {d: {'label': all_fridays[d].strftime('%d %b'), 'style': slider_s
 
 
 point_to_layer = assign("function(feature, latlng, context) {return L.circleMarker(latlng, {color: feature.properties.color});}")
+cell_style = assign("function(feature, context) {return {color: feature.properties.color, weight: 0, fillOpacity: 0.6};}")
 
 app.layout = html.Div(children=[html.Header(title="data-attic - EV Chargers Growth Trend UK"),
                                 html.H1('EV Chargers Growth Trend in the UK'),
@@ -145,6 +149,11 @@ app.layout = html.Div(children=[html.Header(title="data-attic - EV Chargers Grow
                                 ]),
                                 html.Div([], style={'height': '10vh'}),
 
+                                # map mode
+                                html.Div([dcc.RadioItems([{'label': 'charger locations', 'value': 'markers'},
+                                                          {'label': 'coverage heatmap', 'value': 'heatmap'}],
+                                                         id='maptype', value='markers', inline=True)]),
+
                                 # map
                                 html.Div([
                                     html.Div([m])
@@ -160,8 +169,9 @@ app.layout = html.Div(children=[html.Header(title="data-attic - EV Chargers Grow
               Input(component_id='operator', component_property='value'),
                Input(component_id='gtype', component_property='value'),
                Input(component_id="date_slider", component_property="value"),
+               Input(component_id="maptype", component_property="value"),
               )
-def operator_numDC_display(input_operators, graphtype, dateslider):
+def operator_numDC_display(input_operators, graphtype, dateslider, maptype='markers'):
 
     min_ds, max_ds = dateslider
     min_date = all_fridays[min_ds]
@@ -181,11 +191,21 @@ def operator_numDC_display(input_operators, graphtype, dateslider):
     df = agg_t[(agg_t['operatorName'].isin(in_ops_list)) & (agg_t['import_datestamp'] >= min_date) & (
             agg_t['import_datestamp'] < max_date)]
 
-    locs_df = t[(t['operatorName'].isin(in_ops_list)) & (t['import_datestamp'] >= min_date) & (
-            t['import_datestamp'] < max_date)]
+    if maptype == 'heatmap':
+        # sum the pre-aggregated cells, the cost does not grow with the number of locations
+        cells = sum_cells(grid, in_ops_list, min_date, max_date, graphtype)
+        map_layer = dl.GeoJSON(data=cells_to_geojson(cells, graphtype, lambda v: px.colors.sample_colorscale('YlOrRd', v)),
+                               style=cell_style)
+        logging.info(f"Len of cells: {len(cells)}")
+    else:
+        locs_df = t[(t['operatorName'].isin(in_ops_list)) & (t['import_datestamp'] >= min_date) & (
+                t['import_datestamp'] < max_date)]
 
-    circles = [dict(lat=lat, lon=lng, tooltip=tooltip, color=op_colour_dict.get(opname, ''))
-               for lat, lng, tooltip, opname in zip(locs_df['lat'], locs_df['lng'], locs_df['tooltip'], locs_df['operatorName'])]
+        circles = [dict(lat=lat, lon=lng, tooltip=tooltip, color=op_colour_dict.get(opname, ''))
+                   for lat, lng, tooltip, opname in zip(locs_df['lat'], locs_df['lng'], locs_df['tooltip'], locs_df['operatorName'])]
+
+        map_layer = dl.GeoJSON(data=dlx.dicts_to_geojson(circles), pointToLayer=point_to_layer)
+        logging.info(f"Len of circles: {len(circles)}")
 
 
 
@@ -201,9 +221,7 @@ def operator_numDC_display(input_operators, graphtype, dateslider):
                      'numOperationalFastConnectors': 'no. of operational fast connectors'
                  })
 
-    logging.info(f"Len of circles: {len(circles)}")
-
-    return [dcc.Graph(figure=fig),  dl.GeoJSON(data=dlx.dicts_to_geojson(circles), pointToLayer=point_to_layer), date_range_str]
+    return [dcc.Graph(figure=fig), map_layer, date_range_str]
 
 
 if __name__ == '__main__':
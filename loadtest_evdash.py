@@ -0,0 +1,316 @@
+"""
+Load test for the evdash_loc dashboard.
+
+Simulates N concurrent users replaying realistic interaction sequences (operator toggles,
+date slider drags, metric and map mode switches) against the Dash callback endpoint, then reports
+latency percentiles, throughput and response payload sizes per interaction type.
+
+By default the dashboard is started in a separate process on the bundled data/by_loc.csv, optionally
+scaled up with synthetic locations, so the simulated users do not compete with the callbacks for
+the interpreter lock. Use --url to target a dashboard that is already running.
+
+    python loadtest_evdash.py --clients 20 --sequences 10 --scale 5
+"""
+import argparse
+import logging
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import requests
+
+LOC_PATH_LOCAL = "data/by_loc.csv"
+CALLBACK_INPUT_ID = "date_slider"
+REQUEST_TIMEOUT_SECONDS = 30
+SERVER_STARTUP_SECONDS = 120
+
+
+def make_synthetic_table(src_path, scale, seed=0) -> pd.DataFrame:
+    """
+    Scale up the locations table by adding copies of every row, jittered by up to ~5km,
+    so the dashboard has to filter and render proportionally more sites
+    :param src_path: path of the by_loc csv to scale
+    :param scale: how many times the number of rows to produce
+    :return: a dataframe in the by_loc layout
+    """
+    t = pd.read_csv(src_path, index_col=0)
+    if scale <= 1:
+        return t
+
+    rng = np.random.default_rng(seed)
+    copies = [t]
+    for n in range(1, scale):
+        c = t.copy()
+        c['lat'] = c['lat'] + rng.uniform(-0.05, 0.05, len(c))
+        c['lng'] = c['lng'] + rng.uniform(-0.05, 0.05, len(c))
+        c['locationName'] = c['locationName'] + f" #{n}"
+        copies.append(c)
+
+    return pd.concat(copies, ignore_index=True)
+
+
+def serve(port):
+    """
+    Serve the dashboard until killed, run in the child process started by start_local_server.
+    evdash_loc reads its data on import, from the EVDASH_LOC_PATH set by the parent.
+    """
+    # the dashboard logs every callback at INFO, which would swamp the report
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    import evdash_loc
+    from werkzeug.serving import make_server
+
+    make_server('127.0.0.1', port, evdash_loc.app.server, threaded=True).serve_forever()
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_local_server(loc_path, port):
+    """
+    Start the dashboard on the given locations file in a separate process and wait until it answers
+    :return: the base url of the running dashboard and its process, to be terminated by the caller
+    """
+    port = port or free_port()
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, EVDASH_LOC_PATH=os.path.abspath(loc_path))
+    proc = subprocess.Popen([sys.executable, os.path.join(here, 'loadtest_evdash.py'), '--serve', '--port', str(port)],
+                            cwd=here, env=env)
+    url = f"http://127.0.0.1:{port}"
+
+    deadline = time.monotonic() + SERVER_STARTUP_SECONDS
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"The dashboard exited with code {proc.returncode} before serving")
+        try:
+            requests.get(f"{url}/_dash-layout", timeout=1)
+            return url, proc
+        except requests.RequestException:
+            time.sleep(0.5)
+
+    proc.terminate()
+    raise RuntimeError(f"The dashboard did not answer on {url} within {SERVER_STARTUP_SECONDS}s")
+
+
+def find_component(layout, component_id):
+    if isinstance(layout, dict):
+        props = layout.get('props', {})
+        if props.get('id') == component_id:
+            return props
+        children = props.get('children')
+    else:
+        children = layout
+
+    if isinstance(children, (list, dict)):
+        for child in children if isinstance(children, list) else [children]:
+            found = find_component(child, component_id)
+            if found:
+                return found
+    return None
+
+
+def parse_outputs(output):
+    """
+    Split a Dash multi-output string like '..plot1.children...daterange.children..'
+    into the list of {'id', 'property'} the callback endpoint expects
+    """
+    outputs = []
+    for o in output.strip('.').split('...'):
+        oid, prop = o.rsplit('.', 1)
+        outputs.append({'id': oid, 'property': prop})
+    return outputs
+
+
+class Dashboard(object):
+    """
+    What a client needs to know about the dashboard to drive its callback,
+    discovered from the layout and dependencies endpoints
+    """
+
+    def __init__(self, url):
+        self.url = url
+        layout = requests.get(f"{url}/_dash-layout").json()
+        dependencies = requests.get(f"{url}/_dash-dependencies").json()
+
+        self.callback = next(d for d in dependencies
+                             if any(i['id'] == CALLBACK_INPUT_ID for i in d['inputs']))
+        self.outputs = parse_outputs(self.callback['output'])
+
+        self.operators = list(find_component(layout, 'operator')['options'])
+        self.metrics = [o['value'] for o in find_component(layout, 'gtype')['options']]
+        self.map_types = [o['value'] for o in find_component(layout, 'maptype')['options']]
+        slider = find_component(layout, CALLBACK_INPUT_ID)
+        self.slider_min = slider['min']
+        self.slider_max = slider['max']
+        # the layout only carries props set explicitly, RangeSlider defaults to updating on mouseup
+        self.slider_updatemode = slider.get('updatemode', 'mouseup')
+        self.initial_state = {'operator': list(self.operators),
+                              'gtype': find_component(layout, 'gtype')['value'],
+                              'maptype': find_component(layout, 'maptype')['value'],
+                              CALLBACK_INPUT_ID: list(slider['value'])}
+
+    def payload(self, state, changed_id):
+        inputs = [{'id': i['id'], 'property': i['property'], 'value': state[i['id']]}
+                  for i in self.callback['inputs']]
+        return {'output': self.callback['output'],
+                'outputs': self.outputs,
+                'inputs': inputs,
+                'changedPropIds': [f"{changed_id}.value"],
+                'state': []}
+
+
+def interaction_sequence(board, rng, length):
+    """
+    Generate a random user session as a list of (action, changed component id, state) steps.
+    A slider drag sends a single update at the drop point, or one per mark passed when the
+    slider updates while dragging, as the browser does.
+    """
+    state = {k: list(v) if isinstance(v, list) else v for k, v in board.initial_state.items()}
+    steps = [('initial', CALLBACK_INPUT_ID, dict(state))]
+
+    while len(steps) < length:
+        action = rng.choices(['operator', 'slider', 'metric', 'map'], weights=[3, 5, 2, 1])[0]
+
+        if action == 'operator':
+            op = rng.choice(board.operators)
+            ops = [o for o in state['operator'] if o != op] if op in state['operator'] else state['operator'] + [op]
+            state['operator'] = ops
+            steps.append(('operator_toggle', 'operator', dict(state)))
+
+        elif action == 'metric':
+            state['gtype'] = rng.choice(board.metrics)
+            steps.append(('metric_switch', 'gtype', dict(state)))
+
+        elif action == 'map':
+            state['maptype'] = rng.choice(board.map_types)
+            steps.append(('map_switch', 'maptype', dict(state)))
+
+        else:
+            lo, hi = state[CALLBACK_INPUT_ID]
+            handle = rng.randrange(2)
+            target = rng.randint(board.slider_min, hi - 1) if handle == 0 else rng.randint(lo + 1, board.slider_max)
+            current = lo if handle == 0 else hi
+            step = 1 if target > current else -1
+            if board.slider_updatemode == 'drag':
+                positions = range(current + step, target + step, step)
+            else:
+                positions = [target] if target != current else []
+            for pos in positions:
+                value = [pos, hi] if handle == 0 else [lo, pos]
+                state[CALLBACK_INPUT_ID] = value
+                steps.append(('slider_drag', CALLBACK_INPUT_ID, dict(state)))
+
+    return steps[:length]
+
+
+def run_client(board, client_id, num_sequences, sequence_length, think_time, seed, timeout=REQUEST_TIMEOUT_SECONDS):
+    rng = random.Random(seed + client_id)
+    results = []
+    with requests.Session() as session:
+        for _ in range(num_sequences):
+            for action, changed_id, state in interaction_sequence(board, rng, sequence_length):
+                start = time.perf_counter()
+                try:
+                    r = session.post(f"{board.url}/_dash-update-component", json=board.payload(state, changed_id),
+                                     timeout=timeout)
+                    status, size, error = r.status_code, len(r.content), None
+                except requests.RequestException as e:
+                    # timeouts, resets and refused connections count as failed requests, status 0
+                    status, size, error = 0, 0, type(e).__name__
+                elapsed = time.perf_counter() - start
+                results.append({'client': client_id, 'action': action, 'status': status, 'error': error,
+                                'latency_ms': elapsed * 1000, 'bytes': size})
+                if think_time:
+                    time.sleep(rng.uniform(0, think_time))
+    return results
+
+
+def summarize(results, wall_seconds) -> pd.DataFrame:
+    r = pd.DataFrame(results)
+
+    def stats(g):
+        return pd.Series({'requests': len(g),
+                          'errors': int((g['status'] != 200).sum()),
+                          'failed': int(g['error'].notna().sum()),
+                          'p50_ms': g['latency_ms'].quantile(0.50),
+                          'p95_ms': g['latency_ms'].quantile(0.95),
+                          'p99_ms': g['latency_ms'].quantile(0.99),
+                          'mean_kb': g['bytes'].mean() / 1024,
+                          'max_kb': g['bytes'].max() / 1024})
+
+    summary = pd.DataFrame({a: stats(g) for a, g in r.groupby('action')}).T
+    summary.loc['all'] = stats(r)
+    summary['req_per_s'] = summary['requests'] / wall_seconds
+    return summary
+
+
+def run_load_test(url, args):
+    board = Dashboard(url)
+    print(f"Load testing {url} with {args.clients} clients x {args.sequences} sequences x {args.length} requests")
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clients) as pool:
+        futures = [pool.submit(run_client, board, c, args.sequences, args.length, args.think_time, args.seed,
+                               args.timeout)
+                   for c in range(args.clients)]
+        results = [r for f in futures for r in f.result()]
+    wall_seconds = time.perf_counter() - start
+
+    with pd.option_context('display.float_format', '{:.1f}'.format, 'display.width', 160,
+                           'display.max_columns', None):
+        print(summarize(results, wall_seconds))
+    print(f"Total {len(results)} requests in {wall_seconds:.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent-user load test for the EV chargers dashboard")
+    parser.add_argument('--url', help="base url of a running dashboard, otherwise one is started locally")
+    parser.add_argument('--data', default=LOC_PATH_LOCAL, help="locations csv for the local dashboard")
+    parser.add_argument('--scale', type=int, default=1, help="multiply the locations with synthetic copies")
+    parser.add_argument('--port', type=int, default=0, help="port for the local dashboard, 0 picks a free one")
+    parser.add_argument('--clients', type=int, default=10, help="number of concurrent simulated users")
+    parser.add_argument('--sequences', type=int, default=5, help="interaction sequences replayed per user")
+    parser.add_argument('--length', type=int, default=10, help="callback requests per sequence")
+    parser.add_argument('--think-time', type=float, default=0.2, help="max random pause between requests, seconds")
+    parser.add_argument('--timeout', type=float, default=REQUEST_TIMEOUT_SECONDS, help="request timeout, seconds")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    if args.serve:
+        serve(args.port)
+        return
+
+    url, server = args.url, None
+    if not url:
+        loc_path = args.data
+        if args.scale > 1:
+            synthetic = make_synthetic_table(args.data, args.scale, args.seed)
+            loc_path = os.path.join(tempfile.mkdtemp(), 'by_loc.csv')
+            synthetic.to_csv(loc_path)
+            logging.info(f"Generated {len(synthetic)} synthetic locations in {loc_path}")
+        url, server = start_local_server(loc_path, args.port)
+
+    try:
+        run_load_test(url, args)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    main()
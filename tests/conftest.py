@@ -0,0 +1,8 @@
+import pytest
+
+from cloud.util import LocalBucket
+
+
+@pytest.fixture
+def bucket(tmp_path):
+    return LocalBucket(str(tmp_path))
@@ -0,0 +1,59 @@
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+from cloud.batching import ProcessedLedger, drain
+from cloud.functions import analysis_to_json
+from cloud.functions.analysis_to_json import SUMMARY_COLUMNS, analysis_blob_name, ledger_blob_name
+
+
+def snapshot(operators, connectors):
+    rows = [(op, f"{op} site {n}" if n % 3 else None) for op in operators for n in range(len(op))]
+    return pd.DataFrame({'operatorName': [op for op, _ in rows],
+                         'locationName': [name for _, name in rows],
+                         **{c: [connectors] * len(rows) for c in SUMMARY_COLUMNS}})
+
+
+def upload_snapshots(bucket):
+    bucket.upload_blob('data/opencharge-groupA-20240202-0600.csv', snapshot(['Pod', 'Osprey'], 2))
+    bucket.upload_blob('data/opencharge-groupB-20240202-0600.csv', snapshot(['Ionity'], 4))
+    # a retried download of the same day, only the later one counts
+    bucket.upload_blob('data/opencharge-groupA-20240202-1800.csv', snapshot(['Pod', 'Osprey'], 3))
+    bucket.upload_blob('data/opencharge-groupA-20240209-0600.csv', snapshot(['Pod', 'Osprey', 'Ionity'], 5))
+
+
+def analysis(bucket):
+    return analysis_to_json.load_analysis_from_cloud(bucket, analysis_blob_name)
+
+
+def test_rebuild_of_an_empty_folder(bucket):
+    table = analysis_to_json.rebuild_analysis(bucket)
+
+    assert len(table) == 0
+    assert len(analysis(bucket)) == 0
+    assert ProcessedLedger(bucket, ledger_blob_name).exists
+
+
+def test_same_day_snapshots_count_once(bucket):
+    upload_snapshots(bucket)
+    table = analysis_to_json.rebuild_analysis(bucket)
+
+    pod = table.loc[('Pod', pd.Timestamp('2024-02-02').date())]
+    assert pod['numConnectors'] == 3 * 3
+    assert pod['locationName'] == 2
+    assert len(table) == 6
+
+
+def test_incremental_matches_rebuild(bucket):
+    # start from the empty table a first deployment is rebuilt to
+    analysis_to_json.rebuild_analysis(bucket)
+    upload_snapshots(bucket)
+
+    processed = drain(bucket, ledger_blob_name, analysis_to_json.snapshots_folder, analysis_to_json.process_batch,
+                      accept=analysis_to_json.is_snapshot_blob,
+                      order=lambda b: analysis_to_json.snapshot_order(b.name), window_seconds=0, max_batch=1)
+    assert processed == 4
+    incremental = analysis(bucket)
+    assert len(incremental) == 6
+
+    analysis_to_json.rebuild_analysis(bucket)
+    assert_frame_equal(incremental, analysis(bucket))
@@ -0,0 +1,136 @@
+import os
+from datetime import datetime, timedelta, timezone
+
+from cloud.batching import ProcessedLedger, acquire_lease, drain, lease_path_for, release_lease
+
+LEDGER = 'state/test.json'
+
+
+class Recorder(object):
+
+    def __init__(self, failing=()):
+        self.batches = []
+        self.failing = failing
+
+    def __call__(self, bucket, blobs):
+        self.batches.append([b.name for b in blobs])
+        return {b.name: ValueError(f"bad {b.name}") for b in blobs if b.name in self.failing}
+
+    @property
+    def processed(self):
+        return [n for batch in self.batches for n in batch]
+
+
+def run_drain(bucket, recorder, **kwargs):
+    return drain(bucket, LEDGER, 'downloads', recorder, accept=lambda n: n.endswith('json'),
+                 window_seconds=0, **kwargs)
+
+
+def bump_generation(bucket, blob_path):
+    # the local generation is the modification time, move it on explicitly so the test does not race the clock
+    file_path = bucket._file_path(blob_path)
+    st = os.stat(file_path)
+    os.utime(file_path, ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+
+
+def set_created(bucket, blob_path, when):
+    os.utime(bucket._file_path(blob_path), (when.timestamp(), when.timestamp()))
+
+
+def test_drain_processes_pending_blobs_once(bucket):
+    ProcessedLedger(bucket, LEDGER).save()
+    for n in range(3):
+        bucket.upload_json(f'downloads/d{n}.json', [n])
+
+    recorder = Recorder()
+    assert run_drain(bucket, recorder, max_batch=2) == 3
+    assert recorder.batches == [['downloads/d0.json', 'downloads/d1.json'], ['downloads/d2.json']]
+
+    # redelivered events for the same generations find nothing to do
+    assert run_drain(bucket, recorder) == 0
+    assert len(recorder.processed) == 3
+
+    ledger = ProcessedLedger(bucket, LEDGER)
+    for b in bucket.list('downloads'):
+        assert ledger.is_processed(b.name, b.generation)
+
+
+def test_drain_reprocesses_a_new_generation(bucket):
+    ProcessedLedger(bucket, LEDGER).save()
+    bucket.upload_json('downloads/d0.json', [0])
+    bucket.upload_json('downloads/d1.json', [1])
+    run_drain(bucket, Recorder())
+
+    bucket.upload_json('downloads/d1.json', [1, 1])
+    bump_generation(bucket, 'downloads/d1.json')
+
+    recorder = Recorder()
+    assert run_drain(bucket, recorder) == 1
+    assert recorder.processed == ['downloads/d1.json']
+
+
+def test_drain_seeds_the_ledger_on_first_use(bucket):
+    event = datetime.now(timezone.utc) - timedelta(minutes=1)
+    for n in range(4):
+        bucket.upload_json(f'downloads/d{n}.json', [n])
+    set_created(bucket, 'downloads/d0.json', event - timedelta(days=7))
+    set_created(bucket, 'downloads/d1.json', event - timedelta(seconds=1))
+    # d2 triggered the event, d3 landed while the ledger was being seeded
+    set_created(bucket, 'downloads/d2.json', event)
+    set_created(bucket, 'downloads/d3.json', event + timedelta(seconds=1))
+
+    recorder = Recorder()
+    assert run_drain(bucket, recorder, seed_before=event) == 2
+    assert recorder.processed == ['downloads/d2.json', 'downloads/d3.json']
+
+
+def test_failing_blob_does_not_block_the_rest(bucket):
+    ProcessedLedger(bucket, LEDGER).save()
+    for n in range(4):
+        bucket.upload_json(f'downloads/d{n}.json', [n])
+
+    recorder = Recorder(failing=['downloads/d1.json'])
+    assert run_drain(bucket, recorder, max_batch=1) == 3
+    assert recorder.processed == [f'downloads/d{n}.json' for n in range(4)]
+
+    ledger = ProcessedLedger(bucket, LEDGER)
+    d1 = bucket.get_blob('downloads/d1.json')
+    assert ledger.is_failed(d1.name, d1.generation)
+    assert not ledger.is_processed(d1.name, d1.generation)
+
+    # the failure is not retried until the blob is uploaded again
+    assert run_drain(bucket, Recorder()) == 0
+    bucket.upload_json('downloads/d1.json', [1, 1])
+    bump_generation(bucket, 'downloads/d1.json')
+    recorder = Recorder()
+    assert run_drain(bucket, recorder) == 1
+    assert recorder.processed == ['downloads/d1.json']
+
+    d1 = bucket.get_blob('downloads/d1.json')
+    ledger = ProcessedLedger(bucket, LEDGER)
+    assert ledger.is_processed(d1.name, d1.generation)
+    assert not ledger.is_failed(d1.name, d1.generation)
+
+
+def test_drain_leaves_the_work_to_the_lease_holder(bucket):
+    ProcessedLedger(bucket, LEDGER).save()
+    bucket.upload_json('downloads/d0.json', [0])
+    assert acquire_lease(bucket, lease_path_for(LEDGER))
+
+    recorder = Recorder()
+    assert run_drain(bucket, recorder) == 0
+    assert recorder.processed == []
+
+    release_lease(bucket, lease_path_for(LEDGER))
+    assert run_drain(bucket, recorder) == 1
+    assert bucket.get_blob(lease_path_for(LEDGER)) is None
+
+
+def test_stale_lease_is_broken(bucket):
+    lease_path = lease_path_for(LEDGER)
+    assert acquire_lease(bucket, lease_path)
+    assert not acquire_lease(bucket, lease_path)
+
+    stale = (datetime.now() - timedelta(hours=1)).timestamp()
+    os.utime(bucket._file_path(lease_path), (stale, stale))
+    assert acquire_lease(bucket, lease_path)
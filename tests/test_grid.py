@@ -0,0 +1,56 @@
+import math
+import os
+from datetime import timedelta
+
+import pandas as pd
+import pytest
+
+from cloud.grid import GRID_CELL_DEGREES, GRID_SUM_COLUMNS, build_density_grid, calc_next_friday, sum_cells
+
+BY_LOC_PATH = os.path.join(os.path.dirname(__file__), '..', 'data', 'by_loc.csv')
+
+
+@pytest.fixture(scope='module', params=['bundled', 'every_weekday'])
+def locations(request):
+    t = pd.read_csv(BY_LOC_PATH, index_col=0)
+    t['import_datestamp'] = pd.to_datetime(t['import_datestamp']).dt.date
+    if request.param == 'every_weekday':
+        # the downloads mostly land on Fridays, move them onto every day of the week to test the boundaries
+        t['import_datestamp'] = [d + timedelta(days=n % 7) for n, d in enumerate(t['import_datestamp'])]
+    return t
+
+
+@pytest.fixture(scope='module')
+def all_fridays(locations):
+    # the slider positions, worked out as the dashboard does
+    all_dates = sorted(locations['import_datestamp'].unique())
+    end_friday = calc_next_friday(all_dates[-1])
+    num_of_weeks = math.floor((all_dates[-1] - all_dates[0]).days / 7)
+    return [end_friday - timedelta(days=n * 7) for n in reversed(range(num_of_weeks))]
+
+
+def marker_cells(t, operators, from_date, to_date, metric):
+    # what the marker map shows for the same selection, totalled per cell
+    locs = t[t['operatorName'].isin(operators) & (t['import_datestamp'] >= from_date) &
+             (t['import_datestamp'] < to_date)]
+    cells = pd.DataFrame({'cell_lat': (locs['lat'] // GRID_CELL_DEGREES).astype(int),
+                          'cell_lng': (locs['lng'] // GRID_CELL_DEGREES).astype(int),
+                          'loc_count': 1,
+                          **{c: locs[c].astype(int) for c in GRID_SUM_COLUMNS}})
+    cells = cells.groupby(['cell_lat', 'cell_lng'], as_index=False)[metric].sum()
+    return cells[cells[metric] > 0]
+
+
+@pytest.mark.parametrize('metric', ['loc_count', 'numDC'])
+def test_sum_cells_matches_the_marker_filter(locations, all_fridays, metric):
+    grid = build_density_grid(locations)
+    operators = sorted(locations['operatorName'].unique())
+
+    for selected in [operators, operators[::2]]:
+        for lo in range(len(all_fridays) - 1):
+            for hi in range(lo + 1, len(all_fridays)):
+                from_date, to_date = all_fridays[lo], all_fridays[hi]
+                expected = marker_cells(locations, selected, from_date, to_date, metric)
+                cells = sum_cells(grid, selected, from_date, to_date, metric)
+                pd.testing.assert_frame_equal(cells.reset_index(drop=True), expected.reset_index(drop=True),
+                                              check_dtype=False)
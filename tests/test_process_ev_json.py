@@ -0,0 +1,21 @@
+from cloud.batching import ProcessedLedger, drain
+from cloud.functions import process_ev_json
+
+CHARGER = {'OperatorInfo': {'Title': 'MFG'}, 'AddressInfo': {'Latitude': 51.5, 'Longitude': -0.1},
+           'Connections': []}
+
+
+def test_bad_download_is_recorded_and_skipped(bucket):
+    ProcessedLedger(bucket, process_ev_json.ledger_blob_name).save()
+    # an API error body instead of a list of chargers
+    bucket.upload_json('downloads/opencharge-groupA-20240202-0600.json', {'error': 'quota exceeded'})
+    bucket.upload_json('downloads/opencharge-groupA-20240209-0600.json', [CHARGER])
+
+    processed = drain(bucket, process_ev_json.ledger_blob_name, process_ev_json.downloads_folder,
+                      process_ev_json.process_batch, accept=process_ev_json.is_download_blob,
+                      window_seconds=0, max_batch=1)
+
+    assert processed == 1
+    assert [b.name for b in bucket.list('data')] == ['data/opencharge-groupA-20240209-0600.csv']
+    bad = bucket.get_blob('downloads/opencharge-groupA-20240202-0600.json')
+    assert ProcessedLedger(bucket, process_ev_json.ledger_blob_name).is_failed(bad.name, bad.generation)
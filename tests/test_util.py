@@ -0,0 +1,104 @@
+import gzip
+import os
+
+import pandas as pd
+import pytest
+from google.api_core.exceptions import NotFound, PreconditionFailed
+
+from cloud.util import GZIP_MAGIC
+
+
+def write_plain(bucket, blob_path, content):
+    # a blob as written before compression was introduced
+    file_path = bucket._file_path(blob_path)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path, 'w') as f:
+        f.write(content)
+
+
+def test_csv_round_trip_is_gzip_compressed(bucket):
+    t = pd.DataFrame({'operatorName': ['MFG', 'IONITY'], 'numDC': [4, 6]})
+    bucket.upload_blob('analysis/t.csv', t)
+
+    with open(bucket._file_path('analysis/t.csv'), 'rb') as f:
+        assert f.read(2) == GZIP_MAGIC
+
+    assert bucket.read_csv_blob_as_dataframe('analysis/t.csv', has_index=True).equals(t)
+
+
+def test_json_round_trip_is_gzip_compressed(bucket):
+    obj = [{'OperatorInfo': {'Title': 'MFG'}, 'Connections': []}]
+    bucket.upload_json('downloads/x.json', obj)
+
+    with gzip.open(bucket._file_path('downloads/x.json'), 'rt') as f:
+        assert f.read().startswith('[')
+
+    assert bucket.read_json_blob('downloads/x.json') == obj
+
+
+def test_reads_uncompressed_blobs(bucket):
+    write_plain(bucket, 'data/old.csv', 'operatorName,numDC\nMFG,4\n')
+    write_plain(bucket, 'downloads/old.json', '{"a": 1}')
+
+    assert bucket.read_csv_blob_as_dataframe('data/old.csv').to_dict('records') == [{'operatorName': 'MFG', 'numDC': 4}]
+    assert bucket.read_json_blob('downloads/old.json') == {'a': 1}
+    assert bucket.download_blob_as_text('data/old.csv') == 'operatorName,numDC\nMFG,4\n'
+
+
+def test_missing_or_empty_blob_reads_as_none(bucket):
+    write_plain(bucket, 'data/empty.csv', '')
+
+    assert bucket.read_csv_blob_as_dataframe('data/missing.csv') is None
+    assert bucket.read_csv_blob_as_dataframe('data/empty.csv') is None
+    assert bucket.read_json_blob('downloads/missing.json') is None
+
+
+def interrupted_write(f):
+    f.write('partial')
+    raise RuntimeError('upload interrupted')
+
+
+def test_aborted_write_leaves_no_blob(bucket):
+    with pytest.raises(RuntimeError):
+        bucket.write_stream('analysis/t.csv', interrupted_write)
+
+    assert bucket.get_blob('analysis/t.csv') is None
+    assert bucket.list() == []
+
+
+def test_aborted_overwrite_keeps_previous_blob(bucket):
+    bucket.upload_json('state/x.json', {'a': 1})
+
+    with pytest.raises(RuntimeError):
+        bucket.write_stream('state/x.json', interrupted_write)
+
+    assert bucket.read_json_blob('state/x.json') == {'a': 1}
+
+
+def test_if_generation_match(bucket):
+    bucket.upload_json('state/x.json', {'a': 1}, if_generation_match=0)
+    generation = bucket.get_blob('state/x.json').generation
+
+    with pytest.raises(PreconditionFailed):
+        bucket.upload_json('state/x.json', {'a': 2}, if_generation_match=0)
+    with pytest.raises(PreconditionFailed):
+        bucket.upload_json('state/x.json', {'a': 2}, if_generation_match=generation + 1)
+    assert bucket.read_json_blob('state/x.json') == {'a': 1}
+    assert [b.name for b in bucket.list()] == ['state/x.json']
+
+    bucket.upload_json('state/x.json', {'a': 3}, if_generation_match=generation)
+    assert bucket.read_json_blob('state/x.json') == {'a': 3}
+
+
+def test_delete_blob(bucket):
+    bucket.upload_json('state/x.lease', {})
+    generation = bucket.get_blob('state/x.lease').generation
+
+    with pytest.raises(PreconditionFailed):
+        bucket.delete_blob('state/x.lease', if_generation_match=generation + 1)
+
+    bucket.delete_blob('state/x.lease', if_generation_match=generation)
+    assert bucket.get_blob('state/x.lease') is None
+
+    with pytest.raises(NotFound):
+        bucket.delete_blob('state/x.lease')